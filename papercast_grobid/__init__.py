@@ -1 +1 @@
-from .processors import GROBIDProcessor
+from .processors import GROBIDProcessor, init_worker, process_in_worker
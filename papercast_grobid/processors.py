@@ -1,22 +1,46 @@
+import asyncio
+import hashlib
 import logging
 import math
+import os
+import re
+import socket
 import string
 import subprocess
+import tempfile
 import time
-import urllib
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Any, Dict, List
-
-import pdfplumber
-from pdf2image import convert_from_path
-from pdfplumber.page import CroppedPage
-from scipdf import parse_pdf, parse_pdf_to_dict
+from functools import partial
+from html import unescape
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlparse
+
+import requests
+from bs4 import BeautifulSoup
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from papercast.base import BaseProcessor
 from papercast.production import Production
 from papercast.types import Author, PDFFile
 
 
+TEI_NAMESPACE = "http://www.tei-c.org/ns/1.0"
+TEI_NS = {"tei": TEI_NAMESPACE}
+TEI_COORDINATE_ELEMENTS = ["persName", "figure", "ref", "formula", "biblStruct"]
+GROBID_BUSY_RETRIES = 5
+GROBID_RETRY_BACKOFF = 0.5
+GROBID_START_TIMEOUT = 300
+IMAGE_RESOLUTION = 300
+PDF_POINTS_PER_INCH = 72
+
+
 @dataclass
 class PDFBBox:
     page: int
@@ -27,6 +51,13 @@ class PDFBBox:
 
 
 class GROBIDProcessor(BaseProcessor):
+    _author_re = re.compile(
+        r"<author\b[^>]*>(?:(?!</author>).)*?<persName\b[^>]*>"
+        r"(?:(?!</persName>).)*?<forename\b[^>]*>([^<]*)</forename>"
+        r"(?:(?!</persName>).)*?<surname\b[^>]*>([^<]*)</surname>",
+        re.DOTALL,
+    )
+
     input_types = {"pdf": PDFFile}
     output_types = {
         "title": str,
@@ -35,8 +66,8 @@ class GROBIDProcessor(BaseProcessor):
         "description": str,
         "abstract": str,
         "text": str,
-        "figures": List[CroppedPage],
-        "equations": List[CroppedPage],
+        "figures": List,
+        "equations": List,
     }
 
     def __init__(
@@ -44,6 +75,7 @@ class GROBIDProcessor(BaseProcessor):
         remove_non_printable_chars=True,
         serve_grobid_script="~/scipdf_parser/serve_grobid.sh",
         grobid_url="http://localhost:8070/",
+        cache_dir=None,
     ):
         super().__init__()
         self.serve_grobid_script = serve_grobid_script
@@ -51,19 +83,48 @@ class GROBIDProcessor(BaseProcessor):
         self.grobid_url = grobid_url
         self.grobid = None
 
-        if self.serve_grobid_script is not None:
-            while not self._grobid_online():
-                logging.info("GROBID server not started, starting now...")
-                self._start_grobid()
+        # TEI output is cached by PDF content hash so re-runs skip GROBID entirely
+        self.cache_dir = Path(cache_dir).expanduser() if cache_dir is not None else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        # string.printable is pure ASCII, so anything outside ASCII is dropped by
+        # the encode step and only these bytes need deleting afterwards.
+        self._non_printable_bytes = bytes(
+            i for i in range(128) if chr(i) not in string.printable
+        )
+
+        # One pooled, keep-alive session for every request to the GROBID server.
+        # GROBID answers 503 once its request queue is full, so POSTs retry on
+        # that too, with the same backoff as the async path.
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=Retry(
+                total=GROBID_BUSY_RETRIES,
+                connect=3,
+                status_forcelist=[503],
+                allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+                backoff_factor=GROBID_RETRY_BACKOFF,
+                raise_on_status=False,
+            ),
+        )
+        self._session = requests.Session()
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
 
         self.init_logger()
 
+        if self.serve_grobid_script is not None and not self._grobid_online():
+            self.logger.info("GROBID server not started, starting now...")
+            self._start_grobid()
+
     def __del__(self):
         if self.grobid is not None:
             self.grobid.terminate()
 
-    def _extract(self, production: Production) -> Production:
-        article_dict = parse_pdf_to_dict(str(production.pdf.path))
+    def _extract(self, production: Production, tei=None) -> Production:
+        article_dict = self._parse_pdf_to_dict(str(production.pdf.path), tei=tei)
         if article_dict is None:
             raise Exception("Could not parse pdf")
 
@@ -89,27 +150,132 @@ class GROBIDProcessor(BaseProcessor):
         setattr(production, "article_dict", article_dict)
         return production
 
-    def _extract_rich(self, production: Production) -> Production:
-        article_soup = parse_pdf(str(production.pdf.path), soup=True)
-        article_dict = parse_pdf_to_dict(str(production.pdf.path))
+    def _extract_rich(self, production: Production, tei=None) -> Production:
+        # One GROBID round-trip; the dict is derived from the same TEI locally
+        pdf_path = str(production.pdf.path)
+        tei = self._parse_pdf(pdf_path, tei=tei)
+        authors = self._get_authors(tei)
 
-        authors = [
-            Author(
-                first_name=a.find("persname").find("forename").text,
-                last_name=a.find("persname").find("surname").text,
-                # email=a.find("email").text if a.find("email") else None,
-            )
-            for a in article_soup.find("teiheader").find_all("author")
-        ]
+        article_dict = self._parse_pdf_to_dict(pdf_path, tei=tei)
 
         production.authors = authors
         production.title = article_dict["title"]
-        # production = self._get_formula_figure_imgs(production, article_soup)
         text = self._get_text_from_dict(article_dict)
         production.abstract = article_dict["abstract"]
         production.text = text
         return production
 
+    def _get_authors(self, tei: str) -> List[Author]:
+        # GROBID's header authors have a fixed shape, so a regex over the header
+        # is much cheaper than building a tree; anything unusual goes to XPath
+        start = tei.find("<teiHeader")
+        end = tei.find("</teiHeader>", start)
+        if start != -1 and end != -1:
+            header = tei[start:end]
+            names = self._author_re.findall(header)
+            if len(names) == header.count("<persName"):
+                return [
+                    Author(first_name=unescape(first), last_name=unescape(last))
+                    for first, last in names
+                ]
+
+        tei_root = etree.fromstring(tei.encode())
+        return [
+            Author(
+                first_name=persname.findtext("tei:forename", "", TEI_NS),
+                last_name=persname.findtext("tei:surname", "", TEI_NS),
+            )
+            for persname in tei_root.xpath(
+                "//tei:teiHeader//tei:author/tei:persName", namespaces=TEI_NS
+            )
+        ]
+
+    def _grobid_fulltext_url(self) -> str:
+        return self.grobid_url.rstrip("/") + "/api/processFulltextDocument"
+
+    def _fetch_tei(self, pdf_path: str) -> str:
+        # Same request scipdf.parse_pdf makes, but over the pooled session
+        files: List[Any] = [
+            ("teiCoordinates", (None, element)) for element in TEI_COORDINATE_ELEMENTS
+        ]
+        with open(pdf_path, "rb") as f:
+            files.append(("input", f))
+            response = self._session.post(self._grobid_fulltext_url(), files=files)
+        response.raise_for_status()
+        return response.text
+
+    async def _afetch_tei(self, pdf_path: str, session, sem: asyncio.Semaphore) -> str:
+        import aiohttp
+
+        # GROBID answers 503 once its request queue is full; back off and retry
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            async with sem:
+                pdf_bytes = await loop.run_in_executor(None, Path(pdf_path).read_bytes)
+                form = aiohttp.FormData()
+                for element in TEI_COORDINATE_ELEMENTS:
+                    form.add_field("teiCoordinates", element)
+                form.add_field("input", pdf_bytes, filename=Path(pdf_path).name)
+
+                async with session.post(
+                    self._grobid_fulltext_url(), data=form
+                ) as response:
+                    if response.status != 503 or attempt == GROBID_BUSY_RETRIES:
+                        response.raise_for_status()
+                        return await response.text()
+
+            self.logger.info(f"GROBID busy, retrying {pdf_path}...")
+            await asyncio.sleep(GROBID_RETRY_BACKOFF * 2**attempt)
+            attempt += 1
+
+    def _tei_cache_path(self, pdf_path: str) -> Optional[Path]:
+        if self.cache_dir is None:
+            return None
+        digest = hashlib.sha256(Path(pdf_path).read_bytes()).hexdigest()
+        return self.cache_dir / f"{digest}.tei.xml"
+
+    def _write_tei_cache(self, cache_path: Path, tei: str):
+        # Write-then-rename so concurrent workers never see a partial file
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{uuid.uuid4().hex}")
+        try:
+            tmp_path.write_text(tei, encoding="utf-8")
+            tmp_path.replace(cache_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def _read_tei_cache(self, pdf_path: str) -> Tuple[Optional[Path], Optional[str]]:
+        cache_path = self._tei_cache_path(pdf_path)
+        if cache_path is not None and cache_path.exists():
+            self.logger.info(f"Using cached TEI for {pdf_path} at {cache_path}")
+            return cache_path, cache_path.read_text(encoding="utf-8")
+        return cache_path, None
+
+    def _get_tei(self, pdf_path: str) -> str:
+        cache_path, tei = self._read_tei_cache(pdf_path)
+        if tei is not None:
+            return tei
+
+        tei = self._fetch_tei(pdf_path)
+        if cache_path is not None:
+            self._write_tei_cache(cache_path, tei)
+        return tei
+
+    def _parse_pdf(self, pdf_path: str, soup=False, tei=None):
+        if tei is None:
+            tei = self._get_tei(pdf_path)
+
+        if soup:
+            return BeautifulSoup(tei, "lxml")
+        return tei
+
+    def _parse_pdf_to_dict(self, pdf_path: str, tei=None) -> Optional[Dict[str, Any]]:
+        from scipdf.pdf.parse_pdf import convert_article_soup_to_dict
+
+        return convert_article_soup_to_dict(
+            self._parse_pdf(pdf_path, soup=True, tei=tei)
+        )
+
     def _get_tei_obj_bbox(self, tei_obj):
         coords = tei_obj.get("coords").split(",")
         if not len(coords) == 5:
@@ -123,56 +289,90 @@ class GROBIDProcessor(BaseProcessor):
             self.logger.warning(f"Could not parse bbox for {tei_obj}, returning None")
             return None
         page, x0, y0, width, height = coords
+        x0, y0 = math.floor(x0), math.floor(y0)
         bbox = PDFBBox(
             int(page),
-            float(math.floor(x0)),
-            float(math.floor(y0)),
-            float(math.floor(x0)) + float(math.floor(width)),
-            float(math.floor(y0)) + float(math.floor(height)),
+            float(x0),
+            float(y0),
+            float(x0 + math.floor(width)),
+            float(y0 + math.floor(height)),
         )
         self.logger.info(f"Got bbox {bbox} for {tei_obj}")
         return bbox
 
-    def _get_tei_obj_img(self, tei_obj, pdf_path, method="pdfplumber"):
-        from copy import deepcopy
+    def _get_tei_obj_img(self, bbox, page_image):
+        # TEI coordinates are in PDF points; the page image is rendered at
+        # IMAGE_RESOLUTION dpi
+        scale = IMAGE_RESOLUTION / PDF_POINTS_PER_INCH
+        return page_image.crop(
+            (bbox.x0 * scale, bbox.y0 * scale, bbox.x1 * scale, bbox.y1 * scale)
+        )
 
-        bbox = self._get_tei_obj_bbox(tei_obj)
-        if bbox is None:
-            return None
+    def _get_formula_figure_imgs(
+        self, production, tei_root, method="pdfplumber"
+    ) -> Production:
+        formula_bboxes = [
+            self._get_tei_obj_bbox(formula)
+            for formula in tei_root.iter(f"{{{TEI_NAMESPACE}}}formula")
+        ]
+        figure_bboxes = [
+            self._get_tei_obj_bbox(figure)
+            for figure in tei_root.iter(f"{{{TEI_NAMESPACE}}}figure")
+        ]
+
+        crops = self._crop_bboxes(
+            production.pdf.path, formula_bboxes + figure_bboxes, method
+        )
+        production.equations = crops[: len(formula_bboxes)]
+        production.figures = crops[len(formula_bboxes) :]
+        return production
 
+    def _crop_bboxes(self, pdf_path, bboxes, method="pdfplumber"):
+        # Grouping by page rasterizes each page once, and only one full page
+        # image is held at a time; just the crops are kept
+        indices_by_page = defaultdict(list)
+        for i, bbox in enumerate(bboxes):
+            if bbox is not None:
+                indices_by_page[bbox.page].append(i)
+
+        crops: List[Any] = [None] * len(bboxes)
+        with self._page_renderer(pdf_path, method) as render_page:
+            for page_number, indices in sorted(indices_by_page.items()):
+                page_image = render_page(page_number)
+                for i in indices:
+                    crops[i] = self._get_tei_obj_img(bboxes[i], page_image)
+        return crops
+
+    @contextmanager
+    def _page_renderer(self, pdf_path, method="pdfplumber"):
         if method == "pdfplumber":
-            pdf_obj = pdfplumber.open(pdf_path)
-            pages = pdf_obj.pages
-            page = pages[bbox.page - 1]
-            image_bbox = (bbox.x0, bbox.y0, bbox.x1, bbox.y1)
-            cropped_page = page.crop(image_bbox)
-            cropped_page = cropped_page.to_image(resolution=300)
+            import pdfplumber
 
-        elif method == "pdf2image":
-            raise NotImplementedError
-            pages = convert_from_path(pdf_path)
-            page = pages[bbox.page - 1]
-            image_bbox = (bbox.x0, bbox.y0, bbox.x1, bbox.y1)
-            cropped_page = page.crop(image_bbox)
+            with pdfplumber.open(pdf_path) as pdf:
 
-        else:
-            raise NotImplementedError
+                def render_page(page_number):
+                    page = pdf.pages[page_number - 1]
+                    return page.to_image(resolution=IMAGE_RESOLUTION).original
 
-        return cropped_page
+                yield render_page
 
-    def _get_formula_figure_imgs(self, production, article_soup) -> Production:
-        production.equations = []
-        for formula in article_soup.find_all("formula"):
-            formula_img = self._get_tei_obj_img(formula, production.pdf.path)
-            production.equations.append(formula_img)
+        elif method == "pdf2image":
+            from pdf2image import convert_from_path
 
-        production.figures = []
-        for figure in article_soup.find_all("figure"):
-            figure_img = self._get_tei_obj_img(figure, production.pdf.path)
-            production.figures.append(figure_img)
-        return production
+            def render_page(page_number):
+                return convert_from_path(
+                    pdf_path,
+                    dpi=IMAGE_RESOLUTION,
+                    first_page=page_number,
+                    last_page=page_number,
+                )[0]
 
-    def process(self, input: Production, method=None, **kwargs) -> Production:
+            yield render_page
+
+        else:
+            raise NotImplementedError
+
+    def _check_input(self, input: Production):
         # TODO move to base class
         for input_attr in self.input_types:
             if not hasattr(input, input_attr):
@@ -180,11 +380,78 @@ class GROBIDProcessor(BaseProcessor):
                     f"Input object {input} does not have attribute {input_attr}"
                 )
 
+    def process(self, input: Production, method=None, **kwargs) -> Production:
+        self._check_input(input)
+
         if method == "rich":
             return self._extract_rich(input)
         else:
             return self._extract(input)
 
+    def process_batch(
+        self, inputs: List[Production], method=None, max_workers: int = 10, **kwargs
+    ) -> List[Union[Production, BaseException]]:
+        # GROBID handles concurrent requests, so overlap the blocking HTTP calls.
+        # Keep max_workers at or below the server's `concurrency` setting. A
+        # failed PDF comes back as its exception so the rest of the batch is kept.
+        results: List[Union[Production, BaseException, None]] = [None] * len(inputs)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(self.process, production, method=method, **kwargs): i
+                for i, production in enumerate(inputs)
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    self.logger.warning(f"Could not process {inputs[i]}: {e!r}")
+                    results[i] = e
+        return results  # type: ignore
+
+    async def _aextract(
+        self, production: Production, session, sem: asyncio.Semaphore, method=None
+    ) -> Production:
+        self._check_input(production)
+        pdf_path = str(production.pdf.path)
+
+        # Hashing, cache I/O and TEI parsing all block, so keep them off the loop
+        loop = asyncio.get_running_loop()
+        cache_path, tei = await loop.run_in_executor(
+            None, self._read_tei_cache, pdf_path
+        )
+        if tei is None:
+            tei = await self._afetch_tei(pdf_path, session, sem)
+            if cache_path is not None:
+                await loop.run_in_executor(None, self._write_tei_cache, cache_path, tei)
+
+        extract = self._extract_rich if method == "rich" else self._extract
+        return await loop.run_in_executor(None, partial(extract, production, tei=tei))
+
+    async def aprocess_batch(
+        self, inputs: List[Production], method=None, concurrency: int = 10
+    ) -> List[Union[Production, BaseException]]:
+        # One coroutine per PDF; keep concurrency at or below the server's
+        # `concurrency` setting. A failed PDF comes back as its exception so the
+        # rest of the batch is kept.
+        import aiohttp
+
+        sem = asyncio.Semaphore(concurrency)
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            results = await asyncio.gather(
+                *[
+                    self._aextract(production, session, sem, method=method)
+                    for production in inputs
+                ],
+                return_exceptions=True,
+            )
+
+        for production, result in zip(inputs, results):
+            if isinstance(result, BaseException):
+                self.logger.warning(f"Could not process {production}: {result!r}")
+        return results
+
     def _get_text_from_dict(self, article_dict):
         text_elements = [
             article_dict["title"],
@@ -199,23 +466,96 @@ class GROBIDProcessor(BaseProcessor):
         text = "\n\n".join(text_elements)
 
         if self.remove_non_printable_chars:
-            printable = set(string.printable)
-            text = "".join(filter(lambda x: x in printable, text))
+            text = (
+                text.encode("ascii", "ignore")
+                .translate(None, delete=self._non_printable_bytes)
+                .decode("ascii")
+            )
 
         return text
 
-    def _start_grobid(self):
-        cmd = ["bash", "-c", self.serve_grobid_script]
-        self.grobid = subprocess.Popen(
-            cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    @contextmanager
+    def _grobid_start_lock(self):
+        # Processors created concurrently by this user share a lock, so only the
+        # first one launches a GROBID JVM and the rest wait for it
+        try:
+            import fcntl
+        except ImportError:  # Windows: no file locking, start unguarded
+            yield
+            return
+
+        lock_name = hashlib.sha256(self.grobid_url.encode()).hexdigest()[:16]
+        lock_path = (
+            Path(tempfile.gettempdir())
+            / f"papercast_grobid_{os.getuid()}_{lock_name}.lock"
         )
-        while not self._grobid_online():
-            self.logger.info("Waiting for grobid to start...")
-            time.sleep(1)
+        try:
+            lock_file = open(lock_path, "a")
+        except OSError as e:
+            self.logger.warning(
+                f"Could not open {lock_path} ({e}), starting GROBID unguarded"
+            )
+            yield
+            return
+
+        with lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _start_grobid(self):
+        with self._grobid_start_lock():
+            if self._grobid_online():
+                return
+
+            cmd = ["bash", "-c", self.serve_grobid_script]
+            self.grobid = subprocess.Popen(
+                cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            deadline = time.monotonic() + GROBID_START_TIMEOUT
+            while not self._grobid_online():
+                returncode = self.grobid.poll()
+                if returncode is not None:
+                    self.grobid = None
+                    raise RuntimeError(
+                        f"GROBID serve script exited with code {returncode}"
+                    )
+                if time.monotonic() > deadline:
+                    self.grobid.terminate()
+                    self.grobid = None
+                    raise TimeoutError(
+                        f"GROBID did not come up within {GROBID_START_TIMEOUT}s"
+                    )
+                self.logger.info("Waiting for grobid to start...")
+                time.sleep(0.2)
 
     def _grobid_online(self):
+        # A TCP connect is enough to know the server is listening, and avoids
+        # downloading the GROBID home page on every poll
         try:
-            urllib.request.urlopen(self.grobid_url).getcode()  # type: ignore
-            return True
-        except:
+            url = urlparse(self.grobid_url)
+            if url.hostname is None:
+                return False
+            port = url.port or (443 if url.scheme == "https" else 80)
+            with socket.create_connection((url.hostname, port), timeout=0.5):
+                return True
+        except (OSError, ValueError):
             return False
+
+
+# One processor per worker process, so pool workers pay the GROBID startup
+# checks once instead of once per task
+_WORKER_PROCESSOR: Optional[GROBIDProcessor] = None
+
+
+def init_worker(**kwargs):
+    # Use as ProcessPoolExecutor(initializer=partial(init_worker, grobid_url=...));
+    # the server is assumed to be up unless serve_grobid_script is given
+    global _WORKER_PROCESSOR
+    kwargs.setdefault("serve_grobid_script", None)
+    _WORKER_PROCESSOR = GROBIDProcessor(**kwargs)
+
+
+def process_in_worker(production: Production, method=None) -> Production:
+    if _WORKER_PROCESSOR is None:
+        raise RuntimeError("init_worker must be run in this process first")
+    return _WORKER_PROCESSOR.process(production, method=method)
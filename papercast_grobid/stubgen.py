@@ -0,0 +1,113 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import argparse
+import os
+import subprocess
+import shutil
+import pkg_resources
+
+
+def find_papercast() -> str:
+    package = pkg_resources.get_distribution("papercast")
+    return package.location
+
+
+def generate_stubs(plugin_folder, plugin_file, output_dir):
+    cmd = [
+        "stubgen",
+        "-o",
+        str(output_dir / f"{plugin_folder}_{plugin_file}"),
+        "--no-import",
+        "--export-less",
+        "-m",
+        f"{plugin_folder}.{plugin_file}",
+    ]
+    print(" ".join(cmd))
+    subprocess.run(
+        cmd,
+        check=True,
+    )
+
+
+def move_stubs(output_dir):
+    outpath = output_dir / "__init__.pyi"
+    existing = outpath.read_text().splitlines() if outpath.exists() else []
+    to_add = []
+
+    with os.scandir(output_dir) as entries:
+        stub_folders = [Path(entry.path) for entry in entries if entry.is_dir()]
+
+    # Validate every folder before moving anything, so a bad folder can't leave
+    # earlier stubs moved without their import line
+    stub_files = []
+    for stub_folder in stub_folders:
+        folder_files = list(stub_folder.glob("**/*.pyi"))
+
+        if not len(folder_files) == 1:
+            raise ValueError(
+                f"Expected one file in {stub_folder}, found {folder_files}"
+            )
+
+        stub_files.append((stub_folder, folder_files[0]))
+
+    for stub_folder, file in stub_files:
+        file.rename(output_dir / f"{stub_folder.name}.pyi")
+
+        shutil.rmtree(stub_folder)
+
+        content = f"from .{stub_folder.name} import *"
+
+        if content in existing or content in to_add:
+            print(f"Skipping {stub_folder.name} import in __init__.pyi, already exists")
+        else:
+            to_add.append(content)
+
+    # Build the imports in memory and write __init__.pyi once
+    if to_add:
+        outpath.write_text("\n".join(existing + to_add) + "\n")
+
+
+def main(argv=None):
+    # Manual entry point (papercast-grobid-stubs); pip install no longer runs it
+    package_dir = Path(__file__).parent
+
+    parser = argparse.ArgumentParser(
+        description=f"Generate type stubs for the {package_dir.name} plugin"
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=Path,
+        default=package_dir / "stubs",
+        help="where to write the stubs (default: the stubs shipped with the plugin)",
+    )
+    parser.add_argument(
+        "--papercast",
+        action="store_true",
+        help="write into the installed papercast package to register the stubs",
+    )
+    args = parser.parse_args(argv)
+
+    if args.papercast:
+        papercast_dir = find_papercast() + "/papercast"
+
+    jobs = []
+    for plugin_file in package_dir.glob("*.py"):
+        if plugin_file.stem in ["subscribers", "processors", "types", "publishers"]:
+            if args.papercast:
+                output_dir = Path(papercast_dir) / plugin_file.stem / "stubs"
+            else:
+                output_dir = args.output_dir
+            print(f"Generating stubs for {plugin_file} in {output_dir}...")
+            jobs.append((package_dir.name, plugin_file.stem, output_dir))
+
+    # Each stubgen run writes to its own folder, so they can run side by side
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(generate_stubs, *zip(*jobs)))
+
+    # move_stubs appends to a shared __init__.pyi, so it runs once the pool drains
+    for output_dir in dict.fromkeys(output_dir for _, _, output_dir in jobs):
+        move_stubs(output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+from .papercast_grobid_processors import *
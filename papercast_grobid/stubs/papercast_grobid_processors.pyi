@@ -0,0 +1,38 @@
+from _typeshed import Incomplete
+from dataclasses import dataclass
+from papercast.base import BaseProcessor
+from papercast.production import Production as Production
+
+TEI_NAMESPACE: str
+TEI_NS: Incomplete
+TEI_COORDINATE_ELEMENTS: Incomplete
+GROBID_BUSY_RETRIES: int
+GROBID_RETRY_BACKOFF: float
+GROBID_START_TIMEOUT: int
+IMAGE_RESOLUTION: int
+PDF_POINTS_PER_INCH: int
+
+@dataclass
+class PDFBBox:
+    page: int
+    x0: float
+    y0: float
+    x1: float
+    y1: float
+
+class GROBIDProcessor(BaseProcessor):
+    input_types: Incomplete
+    output_types: Incomplete
+    serve_grobid_script: Incomplete
+    remove_non_printable_chars: Incomplete
+    grobid_url: Incomplete
+    grobid: Incomplete
+    cache_dir: Incomplete
+    def __init__(self, remove_non_printable_chars: bool = True, serve_grobid_script: str = '~/scipdf_parser/serve_grobid.sh', grobid_url: str = 'http://localhost:8070/', cache_dir=None) -> None: ...
+    def __del__(self) -> None: ...
+    def process(self, input: Production, method=None, **kwargs) -> Production: ...
+    def process_batch(self, inputs: list[Production], method=None, max_workers: int = 10, **kwargs) -> list[Production | BaseException]: ...
+    async def aprocess_batch(self, inputs: list[Production], method=None, concurrency: int = 10) -> list[Production | BaseException]: ...
+
+def init_worker(**kwargs) -> None: ...
+def process_in_worker(production: Production, method=None) -> Production: ...